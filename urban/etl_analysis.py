@@ -1,8 +1,8 @@
 """
 etl_analysis.py
 
-- Reads loaded data from Supabase table `air_quality_data`
-- Computes KPIs:
+- Reads loaded data from Supabase table `air_quality_data` (paginated)
+- Computes KPIs server-side via RPC (see sql/analysis_functions.sql):
     * City with highest average PM2.5
     * City with highest average severity_score
     * Percentage distribution of risk_flag (High/Moderate/Low)
@@ -17,129 +17,203 @@ etl_analysis.py
 """
 
 import os
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import pandas as pd
-import matplotlib.pyplot as plt
-from supabase import create_client
+import matplotlib
+matplotlib.use("Agg")  # headless: never initialise a GUI backend
+from matplotlib.figure import Figure
+from supabase import create_client, Client
 
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 PROCESSED_DIR = os.getenv("PROCESSED_DIR", "urban/data/processed")
-os.makedirs(PROCESSED_DIR, exist_ok=True)
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise RuntimeError("Please set SUPABASE_URL and SUPABASE_KEY in .env")
-
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# Fetch all rows from Supabase
-resp = supabase.table("air_quality_data").select("*").execute()
-data = resp.data
-
-if not data:
-    print("No data fetched from Supabase table 'air_quality_data'. Exiting.")
-    exit(0)
-
-df = pd.DataFrame(data)
-
-# Ensure correct dtypes
-df["time"] = pd.to_datetime(df["time"], errors="coerce")
-df = df.dropna(subset=["time"])  # drop rows with invalid times
-
-numeric_cols = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide",
-                "sulphur_dioxide", "ozone", "uv_index", "severity_score", "hour"]
-for c in numeric_cols:
-    if c in df.columns:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
-
-# A. KPI Metrics
-city_pm25 = df.groupby("city")["pm2_5"].mean().dropna()
-city_highest_pm2_5 = city_pm25.idxmax() if not city_pm25.empty else None
-
-city_severity = df.groupby("city")["severity_score"].mean().dropna()
-city_highest_severity = city_severity.idxmax() if not city_severity.empty else None
-
-risk_counts = df["risk_flag"].value_counts(dropna=True)
-risk_pct = (risk_counts / risk_counts.sum() * 100).round(2)
-
-df["hour_of_day"] = df["time"].dt.hour
-hourly_pm25 = df.groupby("hour_of_day")["pm2_5"].mean().dropna()
-worst_hour_aqi = int(hourly_pm25.idxmax()) if not hourly_pm25.empty else None
-
-# Save summary metrics CSV
-summary = {
-    "city_highest_pm2_5": [city_highest_pm2_5],
-    "city_highest_severity": [city_highest_severity],
-    "worst_hour_aqi": [worst_hour_aqi]
-}
-summary_df = pd.DataFrame(summary)
-for k, v in risk_pct.items():
-    summary_df[f"risk_pct_{k}"] = v
-summary_df.to_csv(os.path.join(PROCESSED_DIR, "summary_metrics.csv"), index=False)
-
-# B. City Pollution Trend Report
-trend_cols = ["time", "pm2_5", "pm10", "ozone"]
-trend_df = df[["city"] + trend_cols].sort_values(["city", "time"])
-trend_df.to_csv(os.path.join(PROCESSED_DIR, "pollution_trends.csv"), index=False)
-
-# C. City risk distribution
-risk_dist = df.groupby(["city", "risk_flag"]).size().unstack(fill_value=0)
-risk_dist.to_csv(os.path.join(PROCESSED_DIR, "city_risk_distribution.csv"))
-
-# D. Visualizations
-plt.rcParams.update({'figure.max_open_warning': 0})
-
-# 1) Histogram of PM2.5
-plt.figure(figsize=(8,5))
-pm25_vals = df["pm2_5"].dropna()
-plt.hist(pm25_vals, bins=30)
-plt.title("Histogram of PM2.5")
-plt.xlabel("PM2.5")
-plt.ylabel("Frequency")
-plt.tight_layout()
-plt.savefig(os.path.join(PROCESSED_DIR, "pm2_5_histogram.png"))
-plt.close()
-
-# 2) Bar chart of risk flags per city (stacked)
-risk_dist_plot = risk_dist.copy()
-risk_dist_plot.plot(kind="bar", stacked=True, figsize=(10,6))
-plt.title("Risk Flags per City")
-plt.xlabel("City")
-plt.ylabel("Number of Hours")
-plt.tight_layout()
-plt.savefig(os.path.join(PROCESSED_DIR, "risk_flags_bar.png"))
-plt.close()
-
-# 3) Line chart of hourly PM2.5 trends (per city)
-plt.figure(figsize=(12,6))
-for city in df["city"].unique():
-    city_df = df[df["city"] == city].set_index("time").resample("h")["pm2_5"].mean()  # fixed warning
-    if city_df.dropna().empty:
-        continue
-    plt.plot(city_df.index, city_df.values, label=city)
-plt.title("Hourly PM2.5 Trends by City")
-plt.xlabel("Time")
-plt.ylabel("PM2.5")
-plt.legend()
-plt.tight_layout()
-plt.savefig(os.path.join(PROCESSED_DIR, "pm2_5_trends.png"))
-plt.close()
-
-# 4) Scatter: severity_score vs pm2_5
-plt.figure(figsize=(8,5))
-scatter_df = df[["pm2_5", "severity_score", "city"]].dropna(subset=["pm2_5", "severity_score"])
-plt.scatter(scatter_df["pm2_5"], scatter_df["severity_score"], s=10)
-plt.title("Severity Score vs PM2.5")
-plt.xlabel("PM2.5")
-plt.ylabel("Severity Score")
-plt.tight_layout()
-plt.savefig(os.path.join(PROCESSED_DIR, "severity_vs_pm2_5.png"))
-plt.close()
-
-print("Analysis complete. Outputs saved to:", PROCESSED_DIR)
-print("Summary metrics:")
-print(summary_df.to_dict(orient="records")[0])
-print("Risk distribution (%):")
-print(risk_pct.to_dict())
+PAGE_SIZE = int(os.getenv("FETCH_PAGE_SIZE", 1000))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 8))
+FETCH_ORDER_KEY = os.getenv("FETCH_ORDER_KEY", "id")
+
+
+def fetch_all_rows(client: Client, table: str) -> list:
+    """Fetch every row of a table in ordered pages, FETCH_WORKERS pages at a time.
+
+    A single select() is capped by PostgREST's max-rows setting (1000 by
+    default), so the row count is read first and each range fetched separately.
+    Pages are ordered by FETCH_ORDER_KEY, a unique column the table must have
+    (see sql/analysis_functions.sql), so concurrent ranges never overlap.
+    """
+    total = client.table(table).select("*", count="exact", head=True).execute().count or 0
+    if total == 0:
+        return []
+
+    def fetch_page(start: int, size: int) -> list:
+        query = client.table(table).select("*").order(FETCH_ORDER_KEY)
+        return query.range(start, start + size - 1).execute().data
+
+    # A short first page means the server caps rows below PAGE_SIZE; page by that cap instead
+    try:
+        rows = fetch_page(0, PAGE_SIZE)
+    except Exception as e:
+        raise RuntimeError(
+            f"Paged fetch of '{table}' ordered by FETCH_ORDER_KEY={FETCH_ORDER_KEY!r} failed; "
+            f"the table needs that unique column (see sql/analysis_functions.sql): {e}"
+        ) from e
+    page_size = len(rows)
+    if page_size == 0:
+        raise RuntimeError(f"Supabase reported {total} rows in '{table}' but returned none")
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        pages = ex.map(lambda start: fetch_page(start, page_size), range(page_size, total, page_size))
+        for page in pages:
+            rows.extend(page)
+
+    if len(rows) < total:
+        raise RuntimeError(f"Fetched only {len(rows)} of {total} rows from '{table}'")
+    return rows
+
+
+def rpc_series(client: Client, fn: str, key: str, value: str) -> pd.Series:
+    """Call an aggregate RPC and return its rows as a key -> value Series."""
+    rows = client.rpc(fn).execute().data or []
+    return pd.Series({r[key]: r[value] for r in rows}, dtype="float64").dropna()
+
+
+def compute_kpis(client: Client) -> Tuple[pd.DataFrame, pd.Series]:
+    """Return the one-row summary metrics frame and the risk_flag percentages."""
+    # Aggregated in Postgres, only a few rows come back
+    # Both per-city averages come from one grouped scan
+    rows = client.rpc("city_stats").execute().data or []
+    city_stats = pd.DataFrame(rows, columns=["city", "avg_pm2_5", "avg_severity"]).set_index("city").astype("float64")
+
+    city_pm25 = city_stats["avg_pm2_5"].dropna()
+    city_highest_pm2_5 = city_pm25.idxmax() if not city_pm25.empty else None
+
+    city_severity = city_stats["avg_severity"].dropna()
+    city_highest_severity = city_severity.idxmax() if not city_severity.empty else None
+
+    risk_counts = rpc_series(client, "risk_counts", "risk_flag", "n").sort_values(ascending=False)
+    risk_pct = (risk_counts / risk_counts.sum() * 100).round(2)
+
+    hourly_pm25 = rpc_series(client, "hourly_avg_pm25", "hour", "avg_pm2_5")
+    worst_hour_aqi = int(hourly_pm25.idxmax()) if not hourly_pm25.empty else None
+
+    summary = {
+        "city_highest_pm2_5": [city_highest_pm2_5],
+        "city_highest_severity": [city_highest_severity],
+        "worst_hour_aqi": [worst_hour_aqi]
+    }
+    summary_df = pd.DataFrame(summary)
+    for k, v in risk_pct.items():
+        summary_df[f"risk_pct_{k}"] = v
+    return summary_df, risk_pct
+
+
+def save_plots(df: pd.DataFrame, trend_df: pd.DataFrame, risk_dist: pd.DataFrame) -> None:
+    """Write the four PNG visualizations to PROCESSED_DIR."""
+    # Figures are built with the object-oriented API, bypassing pyplot's global figure registry
+    # 1) Histogram of PM2.5
+    fig = Figure(figsize=(8,5))
+    ax = fig.subplots()
+    pm25_vals = df["pm2_5"].dropna()
+    ax.hist(pm25_vals, bins=30)
+    ax.set_title("Histogram of PM2.5")
+    ax.set_xlabel("PM2.5")
+    ax.set_ylabel("Frequency")
+    fig.tight_layout()
+    fig.savefig(os.path.join(PROCESSED_DIR, "pm2_5_histogram.png"))
+
+    # 2) Bar chart of risk flags per city (stacked)
+    fig = Figure(figsize=(10,6))
+    ax = fig.subplots()
+    risk_dist.plot(kind="bar", stacked=True, ax=ax)
+    ax.set_title("Risk Flags per City")
+    ax.set_xlabel("City")
+    ax.set_ylabel("Number of Hours")
+    fig.tight_layout()
+    fig.savefig(os.path.join(PROCESSED_DIR, "risk_flags_bar.png"))
+
+    # 3) Line chart of hourly PM2.5 trends (per city)
+    fig = Figure(figsize=(12,6))
+    ax = fig.subplots()
+    # One grouped pass: rows = hourly bins, columns = cities
+    hourly_trend = trend_df.groupby(["city", pd.Grouper(key="time", freq="h")])["pm2_5"].mean().unstack(0)
+    hourly_trend = hourly_trend.dropna(axis=1, how="all")
+    if not hourly_trend.empty:
+        hourly_trend.plot(ax=ax)  # also draws the city legend
+    ax.set_title("Hourly PM2.5 Trends by City")
+    ax.set_xlabel("Time")
+    ax.set_ylabel("PM2.5")
+    fig.tight_layout()
+    fig.savefig(os.path.join(PROCESSED_DIR, "pm2_5_trends.png"))
+
+    # 4) Density of severity_score vs pm2_5 (hexbin: binned once, drawn per cell not per point)
+    fig = Figure(figsize=(8,5))
+    ax = fig.subplots()
+    scatter_df = df[["pm2_5", "severity_score", "city"]].dropna(subset=["pm2_5", "severity_score"])
+    if not scatter_df.empty:
+        hb = ax.hexbin(scatter_df["pm2_5"], scatter_df["severity_score"], gridsize=60, mincnt=1)
+        fig.colorbar(hb, ax=ax, label="Hours")
+    ax.set_title("Severity Score vs PM2.5")
+    ax.set_xlabel("PM2.5")
+    ax.set_ylabel("Severity Score")
+    fig.tight_layout()
+    fig.savefig(os.path.join(PROCESSED_DIR, "severity_vs_pm2_5.png"))
+
+
+def run() -> None:
+    """Fetch loaded data and write KPI/trend CSVs and plots to PROCESSED_DIR."""
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise RuntimeError("Please set SUPABASE_URL and SUPABASE_KEY in .env")
+    os.makedirs(PROCESSED_DIR, exist_ok=True)
+
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+    # Fetch all rows from Supabase (only needed for the trend report and plots)
+    data = fetch_all_rows(client, "air_quality_data")
+
+    if not data:
+        print("No data fetched from Supabase table 'air_quality_data'. Exiting.")
+        return
+
+    df = pd.DataFrame(data)
+
+    # Ensure correct dtypes (hour-of-day KPIs use the stored `hour` column server-side)
+    numeric_cols = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide",
+                    "sulphur_dioxide", "ozone", "uv_index", "severity_score"]
+    for c in numeric_cols:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+
+    # A. KPI Metrics
+    summary_df, risk_pct = compute_kpis(client)
+    summary_df.to_csv(os.path.join(PROCESSED_DIR, "summary_metrics.csv"), index=False)
+
+    # B. City Pollution Trend Report
+    # Only the trend report and chart need real datetimes, so parse time just for them
+    trend_cols = ["time", "pm2_5", "pm10", "ozone"]
+    trend_df = df[["city"] + trend_cols].copy()
+    trend_df["time"] = pd.to_datetime(trend_df["time"], errors="coerce")
+    trend_df = trend_df.dropna(subset=["time"]).sort_values(["city", "time"])  # drop rows with invalid times
+    trend_df.to_csv(os.path.join(PROCESSED_DIR, "pollution_trends.csv"), index=False)
+
+    # C. City risk distribution
+    # Categorical keys let groupby hash integer codes instead of Python strings
+    df["city"] = df["city"].astype("category")
+    df["risk_flag"] = df["risk_flag"].astype("category")
+    risk_dist = df.groupby(["city", "risk_flag"], observed=True).size().unstack(fill_value=0)
+    risk_dist.to_csv(os.path.join(PROCESSED_DIR, "city_risk_distribution.csv"))
+
+    # D. Visualizations
+    save_plots(df, trend_df, risk_dist)
+
+    print("Analysis complete. Outputs saved to:", PROCESSED_DIR)
+    print("Summary metrics:")
+    print(summary_df.to_dict(orient="records")[0])
+    print("Risk distribution (%):")
+    print(risk_pct.to_dict())
+
+
+if __name__ == "__main__":
+    run()
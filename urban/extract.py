@@ -13,7 +13,7 @@ import time
 import logging
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 import requests
 from dotenv import load_dotenv
 
@@ -124,23 +124,32 @@ def _fetch_city(city: Dict[str, float]) -> Optional[str]:
     return None
 
 
-def fetch_all_cities(cities: List[Dict[str, float]] = CITIES) -> List[str]:
-    saved_files = []
+def iter_fetch_cities(cities: List[Dict[str, float]] = CITIES) -> Iterator[str]:
+    """Yield each saved raw file path as soon as its city has been fetched."""
     for city in cities:
         logging.info(f"Starting extraction for {city['name']}")
         path = _fetch_city(city)
         if path:
-            saved_files.append(path)
+            yield path
         time.sleep(SLEEP_BETWEEN_CALLS)
-    return saved_files
 
 
-# --------------------------
-# CLI RUN
-# --------------------------
-if __name__ == "__main__":
+def fetch_all_cities(cities: List[Dict[str, float]] = CITIES) -> List[str]:
+    return list(iter_fetch_cities(cities))
+
+
+def run() -> List[str]:
+    """Fetch every configured city and return the saved raw file paths."""
     logging.info("Starting Open-Meteo Air Quality extraction for Indian cities")
     saved_paths = fetch_all_cities()
     logging.info("Extraction complete. Summary:")
     for path in saved_paths:
-        print(f" - {path}")
\ No newline at end of file
+        print(f" - {path}")
+    return saved_paths
+
+
+# --------------------------
+# CLI RUN
+# --------------------------
+if __name__ == "__main__":
+    run()
@@ -1,20 +1,25 @@
 """
 Load step for AtmosTrack Air Quality ETL.
 
-- Reads transformed CSV: data/staged/air_quality_transformed.csv
+- Reads transformed Parquet: data/staged/air_quality_transformed.parquet
+  (path from STAGED_FILE; the older STAGED_CSV name is still read as a fallback)
 - Inserts records into Supabase table: air_quality_data
 - Batch size = 200
-- Converts NaN -> NULL
+- Serializes batches straight to JSON (NaN -> null) and POSTs them to PostgREST
 - Datetime converted to ISO format
 - Retry failed batches (2 retries)
+- Inserts batches concurrently (LOAD_WORKERS threads, default 8)
 - Renames columns to match Supabase table
 """
 
 import os
+import httpx
 import pandas as pd
-from supabase import create_client
+from typing import Optional
+from supabase import create_client, Client
 from dotenv import load_dotenv
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # --------------------------
 # LOAD ENV
@@ -23,54 +28,101 @@ load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-STAGED_CSV = os.getenv("STAGED_CSV", "data/staged/air_quality_transformed.csv")
+# STAGED_CSV is the pre-Parquet name of this setting, still honoured
+STAGED_FILE = os.getenv("STAGED_FILE") or os.getenv("STAGED_CSV", "data/staged/air_quality_transformed.parquet")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 200))
 MAX_RETRIES = int(os.getenv("LOAD_MAX_RETRIES", 2))
-
-# --------------------------
-# INIT SUPABASE CLIENT
-# --------------------------
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# --------------------------
-# LOAD DATA
-# --------------------------
-df = pd.read_csv(STAGED_CSV)
-
-# Convert datetime to ISO string
-df["time"] = pd.to_datetime(df["time"]).dt.strftime("%Y-%m-%dT%H:%M:%S")
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", 8))
+TABLE = "air_quality_data"
 
 # Rename columns to match Supabase table
-rename_map = {
+RENAME_MAP = {
     "AQI": "aqi_category",
     "severity": "severity_score",
     "risk": "risk_flag"
 }
-df = df.rename(columns=rename_map)
 
-# Replace NaN with None for Supabase
-df = df.where(pd.notnull(df), None)
 
-records = df.to_dict(orient="records")
-total_inserted = 0
+def prepare(df: pd.DataFrame) -> pd.DataFrame:
+    """Return a copy of the transformed frame shaped for the Supabase table."""
+    df = df.rename(columns=RENAME_MAP)
+
+    # Parquet keeps time as datetime64; only format it to an ISO string
+    df["time"] = df["time"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+    # Categorical columns and NaN need no conversion: to_json writes labels and null
+    return df
 
 # --------------------------
 # BATCH INSERT
 # --------------------------
-for i in range(0, len(records), BATCH_SIZE):
-    batch = records[i:i+BATCH_SIZE]
+def batches(df: pd.DataFrame, n: int):
+    """Yield (batch_no, rows, JSON body) per slice of df, serialized without per-row dicts."""
+    for i in range(0, len(df), n):
+        batch = df.iloc[i:i+n]
+        yield i // n + 1, len(batch), batch.to_json(orient="records", double_precision=15).encode()
+
+
+def insert_batch(session: httpx.Client, batch_no: int, rows: int, body: bytes) -> int:
+    """Insert one batch with exponential backoff; returns rows inserted."""
     attempt = 0
     while attempt <= MAX_RETRIES:
         try:
-            supabase.table("air_quality_data").insert(batch).execute()
-            total_inserted += len(batch)
-            print(f"Inserted batch {i//BATCH_SIZE + 1} ({len(batch)} rows)")
-            break
+            resp = session.post(
+                f"/{TABLE}",
+                content=body,
+                headers={"Content-Type": "application/json", "Prefer": "return=minimal"},
+            )
+            resp.raise_for_status()
+            print(f"Inserted batch {batch_no} ({rows} rows)")
+            return rows
         except Exception as e:
             attempt += 1
-            print(f"⚠️ Batch insert failed (attempt {attempt}): {e}")
+            print(f"⚠️ Batch {batch_no} insert failed (attempt {attempt}): {e}")
             time.sleep(2 ** attempt)
-    else:
-        print(f"❌ Failed to insert batch {i//BATCH_SIZE + 1} after {MAX_RETRIES} retries")
+    print(f"❌ Failed to insert batch {batch_no} after {MAX_RETRIES} retries")
+    return 0
+
+
+def load_frame(client: Client, df: pd.DataFrame) -> int:
+    """Insert one transformed frame in concurrent batches; returns rows inserted."""
+    df = prepare(df)
+
+    # Reuse the PostgREST client's session (base URL, auth headers, keep-alive pool).
+    # client.postgrest is built lazily, so resolve it here once rather than racing
+    # to create it from every worker thread.
+    session = client.postgrest.session
+
+    # At most 2 * LOAD_WORKERS batches are in flight, so bodies are never all in memory.
+    total_inserted = 0
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as ex:
+        pending = set()
+        for batch_no, rows, body in batches(df, BATCH_SIZE):
+            if len(pending) >= 2 * LOAD_WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                total_inserted += sum(f.result() for f in done)
+            pending.add(ex.submit(insert_batch, session, batch_no, rows, body))
+        total_inserted += sum(f.result() for f in wait(pending).done)
+    return total_inserted
+
+
+def get_client() -> Client:
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+def run(df: Optional[pd.DataFrame] = None) -> int:
+    """Insert the transformed frame (default: read STAGED_FILE); returns rows inserted."""
+    client = get_client()
+    if df is None:
+        df = pd.read_parquet(STAGED_FILE)
+        # Staged pollutants are float32; widen via their shortest repr so 50.9
+        # is sent as 50.9 rather than 50.900001525878906
+        f32_cols = df.select_dtypes("float32").columns
+        df[f32_cols] = df[f32_cols].astype(str).astype("float64")
+    total_inserted = load_frame(client, df)
+    print(f"✅ Total inserted rows: {total_inserted}")
+    return total_inserted
+
 
-print(f"✅ Total inserted rows: {total_inserted}")
\ No newline at end of file
+if __name__ == "__main__":
+    run()
@@ -1,33 +1,131 @@
-import subprocess
 import sys
 import time
+import queue
+import threading
+import traceback
 
-def run_step(step_name, script_name):
+import pandas as pd
+
+import extract
+import transform
+import load
+import etl_analysis
+
+# Bounded hand-off queues between stages; None marks end of stream
+QUEUE_SIZE = 4
+
+
+class Channel:
+    """Bounded queue between two pipeline stages, closed with a None sentinel."""
+
+    def __init__(self, maxsize=QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.exhausted = False
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def close(self):
+        self._queue.put(None)
+
+    def __iter__(self):
+        # Compare by identity: `None == df` would call DataFrame.__eq__
+        while (item := self._queue.get()) is not None:
+            yield item
+        self.exhausted = True
+
+    def drain(self):
+        # Keep the upstream stage from blocking on a full queue after a failure
+        while not self.exhausted:
+            if self._queue.get() is None:
+                self.exhausted = True
+
+
+def run_step(step_name, func, *args):
     print(f"\n🟦 Running Step: {step_name}")
-    print(f"📄 Executing: {script_name}")
+    print(f"📄 Executing: {func.__module__}.{func.__name__}()")
 
+    start = time.time()
     try:
-        start = time.time()
-        result = subprocess.run(
-            [sys.executable, script_name],
-            capture_output=True,
-            text=True
-        )
-        end = time.time()
-
-        print(f"⏳ Time Taken: {round(end - start, 2)}s")
-
-        if result.returncode != 0:
-            print(f"❌ ERROR running {script_name}")
-            print(result.stderr)
-            sys.exit(1)
-
-        print(f"✅ Completed: {step_name}")
-        print(result.stdout)
-
-    except FileNotFoundError:
-        print(f"❌ Could not find script: {script_name}")
+        result = func(*args)
+    except Exception:
+        print(f"❌ ERROR running {step_name}")
+        traceback.print_exc()
+        sys.exit(1)
+    end = time.time()
+
+    print(f"⏳ Time Taken: {round(end - start, 2)}s")
+    print(f"✅ Completed: {step_name}")
+    return result
+
+
+def extract_stage(outbox):
+    for path in extract.iter_fetch_cities():
+        outbox.put(path)
+
+
+def transform_stage(inbox, outbox):
+    # Files arrive one at a time at extract's pace (one city fetch per
+    # SLEEP_BETWEEN_CALLS), so they are transformed in this thread as they come
+    # rather than through transform.run()'s process pool.
+    frames = []
+    for path in inbox:
+        df = transform.transform_file(path)
+        if df is not None:
+            frames.append(df)
+            outbox.put(df)
+    if not frames:
+        print("⚠️ No raw data was transformed; nothing staged.")
+        return
+    df = pd.concat(frames, copy=False, ignore_index=True)
+    # Per-city frames each carry a one-category `city`, which concat turns into object
+    df["city"] = df["city"].astype("category")
+    transform.save(df)
+
+
+def load_stage(inbox):
+    client = load.get_client()
+    total_inserted = 0
+    for df in inbox:
+        total_inserted += load.load_frame(client, df)
+    print(f"✅ Total inserted rows: {total_inserted}")
+
+
+def run_stage(step_name, func, inbox, outbox, errors):
+    start = time.time()
+    try:
+        func(*[c for c in (inbox, outbox) if c is not None])
+    except Exception:
+        errors.append(step_name)
+        print(f"❌ ERROR running {step_name}")
+        traceback.print_exc()
+        if inbox is not None:
+            inbox.drain()
+    finally:
+        if outbox is not None:
+            outbox.close()
+    print(f"⏳ {step_name} finished in {round(time.time() - start, 2)}s")
+
+
+def run_streaming():
+    """Run extract, transform and load concurrently, each file flowing through as soon as it is ready."""
+    print("\n🟦 Running Steps: 1️⃣ Extract → 2️⃣ Transform → 3️⃣ Load into Supabase (pipelined)")
+    files, frames = Channel(), Channel()
+    errors = []
+    stages = [
+        ("1️⃣ Extract", extract_stage, None, files),
+        ("2️⃣ Transform", transform_stage, files, frames),
+        ("3️⃣ Load into Supabase", load_stage, frames, None),
+    ]
+    threads = [threading.Thread(target=run_stage, args=(*stage, errors), name=stage[0]) for stage in stages]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
         sys.exit(1)
+    print("✅ Completed: Extract, Transform, Load")
 
 
 def main():
@@ -35,10 +133,9 @@ def main():
     print("🚀 AIR QUALITY ETL PIPELINE")
     print("==============================\n")
 
-    run_step("1️⃣ Extract", "extract.py")
-    run_step("2️⃣ Transform", "transform.py")
-    run_step("3️⃣ Load into Supabase", "load.py")
-    run_step("4️⃣ Analysis & Reports", "etl_analysis.py")
+    # Wall time is bounded by the slowest of extract/transform/load rather than their sum
+    run_streaming()
+    run_step("4️⃣ Analysis & Reports", etl_analysis.run)
 
     print("\n==============================")
     print("🎉 ETL Pipeline Finished Successfully!")
@@ -46,4 +143,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,36 @@
+-- Aggregate functions for etl_analysis.py, called through PostgREST RPC
+-- (supabase.rpc("<name>")). Run once in the Supabase SQL editor.
+--
+-- etl_analysis.py also pages through air_quality_data ordered by a unique
+-- column (FETCH_ORDER_KEY, default "id"). load.py never sends one, and
+-- (city, time) repeats on every load, so the table needs a generated key,
+-- e.g. when it does not already have one:
+--
+--     alter table air_quality_data
+--         add column id bigint generated always as identity primary key;
+
+create or replace function city_stats()
+returns table (city text, avg_pm2_5 double precision, avg_severity double precision)
+language sql stable as $$
+    select city, avg(pm2_5)::double precision, avg(severity_score)::double precision
+    from air_quality_data
+    group by city;
+$$;
+
+create or replace function hourly_avg_pm25()
+returns table (hour integer, avg_pm2_5 double precision)
+language sql stable as $$
+    select hour::integer, avg(pm2_5)::double precision
+    from air_quality_data
+    where pm2_5 is not null and hour is not null
+    group by hour;
+$$;
+
+create or replace function risk_counts()
+returns table (risk_flag text, n bigint)
+language sql stable as $$
+    select risk_flag, count(*)
+    from air_quality_data
+    where risk_flag is not null
+    group by risk_flag;
+$$;
@@ -8,16 +8,25 @@ Transform step for AtmosTrack Air Quality ETL.
     - Pollution severity score
     - Risk classification
     - Hour of day
-- Saves transformed data into data/staged/air_quality_transformed.csv
+- Saves transformed data into data/staged/air_quality_transformed.parquet
 """
 
 import os
-import json
+import orjson
+import threading
 from pathlib import Path
 from datetime import datetime
+from typing import Iterable, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; fall back to the NumPy path
+    njit = None
+
 # --------------------------
 # LOAD ENV
 # --------------------------
@@ -26,57 +35,76 @@ load_dotenv()
 RAW_DIR = Path(os.getenv("RAW_DIR", "data/raw"))
 STAGED_DIR = Path(os.getenv("STAGED_DIR", "data/staged"))
 STAGED_DIR.mkdir(parents=True, exist_ok=True)
-OUTPUT_FILE = STAGED_DIR / "air_quality_transformed.csv"
+OUTPUT_FILE = STAGED_DIR / "air_quality_transformed.parquet"
+TRANSFORM_WORKERS = int(os.getenv("TRANSFORM_WORKERS", os.cpu_count() or 1))
+# Below this many rows the NumPy path beats the Numba kernel's thread start-up
+NUMBA_MIN_ROWS = int(os.getenv("NUMBA_MIN_ROWS", 10000))
 
 POLLUTANTS = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide", "sulphur_dioxide", "ozone", "uv_index"]
 
+# Severity weights, aligned with SEVERITY_COLS
+SEVERITY_COLS = ["pm2_5", "pm10", "nitrogen_dioxide", "sulphur_dioxide", "carbon_monoxide", "ozone"]
+SEVERITY_WEIGHTS = np.array([5, 3, 4, 4, 2, 3], dtype=np.float64)
+
+# AQI category by PM2.5 (right-inclusive bins: <=50 Good, <=100 Moderate, ...)
+AQI_BINS = [-np.inf, 50, 100, 200, 300, np.inf]
+AQI_LABELS = ["Good", "Moderate", "Unhealthy", "Very Unhealthy", "Hazardous"]
+
+# Risk class by severity score (>200 Moderate, >400 High); labels indexed by code
+RISK_MODERATE = 200.0
+RISK_HIGH = 400.0
+RISK_LABELS = ["Low Risk", "Moderate Risk", "High Risk"]
+
 # --------------------------
 # UTILITY FUNCTIONS
 # --------------------------
-def compute_aqi(pm2_5: float) -> str:
-    if pd.isna(pm2_5):
+def _numeric_column(values: list, length: int) -> pd.Series:
+    # Coerce one pollutant array to float, padding/truncating to the time axis
+    col = pd.to_numeric(pd.Series(values[:length], dtype="object"), errors="coerce")
+    return col.astype("float64").reindex(pd.RangeIndex(length))
+
+def _severity_risk_numpy(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    severity = np.nan_to_num(values) @ SEVERITY_WEIGHTS
+    risk = (severity > RISK_MODERATE).astype(np.int8) + (severity > RISK_HIGH).astype(np.int8)
+    return severity, risk
+
+if njit is not None:
+    # No fastmath: it would let LLVM assume no NaNs and drop the missing-reading check
+    @njit(parallel=True, cache=True)
+    def _severity_risk_kernel(values, weights, sev_out, risk_out):
+        for i in prange(values.shape[0]):
+            s = 0.0
+            for j in range(values.shape[1]):
+                v = values[i, j]
+                if v == v:  # skip NaN
+                    s += v * weights[j]
+            sev_out[i] = s
+            risk_out[i] = 2 if s > RISK_HIGH else 1 if s > RISK_MODERATE else 0
+
+def severity_and_risk(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (severity score, risk code) for an (n, len(SEVERITY_COLS)) float64 array.
+
+    Missing readings count as 0. Risk codes index into RISK_LABELS.
+    """
+    # The prange kernel is used only for large inputs on the main thread. Under
+    # Numba's default TBB threading layer, launching a parallel kernel from a
+    # worker thread (run_pipeline's streamed transform stage) leaves the process
+    # hung at interpreter exit; small per-city frames gain nothing from it anyway.
+    if (njit is None or values.shape[0] < NUMBA_MIN_ROWS
+            or threading.current_thread() is not threading.main_thread()):
+        return _severity_risk_numpy(values)
+    sev_out = np.empty(values.shape[0], dtype=np.float64)
+    risk_out = np.empty(values.shape[0], dtype=np.int8)
+    _severity_risk_kernel(np.ascontiguousarray(values), SEVERITY_WEIGHTS, sev_out, risk_out)
+    return sev_out, risk_out
+
+def process_file(json_file: Path) -> Optional[pd.DataFrame]:
+    """Flatten one raw Open-Meteo JSON file into a per-hour DataFrame."""
+    try:
+        data = orjson.loads(json_file.read_bytes())
+    except orjson.JSONDecodeError:
+        print(f"Skipping invalid JSON: {json_file}")
         return None
-    if pm2_5 <= 50:
-        return "Good"
-    elif pm2_5 <= 100:
-        return "Moderate"
-    elif pm2_5 <= 200:
-        return "Unhealthy"
-    elif pm2_5 <= 300:
-        return "Very Unhealthy"
-    else:
-        return "Hazardous"
-
-def compute_severity(row: pd.Series) -> float:
-    return (
-        (row.get("pm2_5", 0) * 5) +
-        (row.get("pm10", 0) * 3) +
-        (row.get("nitrogen_dioxide", 0) * 4) +
-        (row.get("sulphur_dioxide", 0) * 4) +
-        (row.get("carbon_monoxide", 0) * 2) +
-        (row.get("ozone", 0) * 3)
-    )
-
-def classify_risk(severity: float) -> str:
-    if severity > 400:
-        return "High Risk"
-    elif severity > 200:
-        return "Moderate Risk"
-    else:
-        return "Low Risk"
-
-# --------------------------
-# TRANSFORM
-# --------------------------
-all_records = []
-
-for json_file in RAW_DIR.glob("*_raw_*.json"):
-    with open(json_file, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            print(f"Skipping invalid JSON: {json_file}")
-            continue
 
     # Extract city name from filename
     city = json_file.stem.split("_raw_")[0].replace("_", " ").title()
@@ -85,28 +113,77 @@ for json_file in RAW_DIR.glob("*_raw_*.json"):
     hourly = data.get("hourly", {})
     times = hourly.get("time", [])
     if not times:
-        continue
-
-    # Build rows
-    for i, timestamp in enumerate(times):
-        row = {"city": city, "time": pd.to_datetime(timestamp)}
-        for pol in POLLUTANTS:
-            values = hourly.get(pol, [])
-            row[pol] = pd.to_numeric(values[i], errors="coerce") if i < len(values) else None
-        all_records.append(row)
-
-# Create DataFrame
-df = pd.DataFrame(all_records)
-
-# Remove rows where all pollutant readings are missing
-df = df.dropna(subset=POLLUTANTS, how="all")
-
-# Derived features
-df["AQI"] = df["pm2_5"].apply(compute_aqi)
-df["severity"] = df.apply(compute_severity, axis=1)
-df["risk"] = df["severity"].apply(classify_risk)
-df["hour"] = df["time"].dt.hour
-
-# Save transformed CSV
-df.to_csv(OUTPUT_FILE, index=False)
-print(f"Transformed data saved to: {OUTPUT_FILE}")
\ No newline at end of file
+        return None
+
+    # hourly is already column-oriented: build the frame straight from its arrays
+    n = len(times)
+    columns = {pol: hourly[pol] for pol in POLLUTANTS if pol in hourly}
+    if all(len(values) == n for values in columns.values()):
+        frame = pd.DataFrame(columns, index=pd.RangeIndex(n)).reindex(columns=POLLUTANTS)
+        frame = frame.apply(pd.to_numeric, errors="coerce").astype("float64")
+    else:
+        # Ragged arrays: pad/truncate each pollutant to the time axis
+        frame = pd.DataFrame({pol: _numeric_column(hourly.get(pol, []), n) for pol in POLLUTANTS})
+    frame.insert(0, "city", city)
+    frame.insert(1, "time", pd.to_datetime(times, utc=False, cache=True))
+    return frame
+
+# --------------------------
+# TRANSFORM
+# --------------------------
+def add_features(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop empty rows and add AQI, severity, risk and hour columns."""
+    # Remove rows where all pollutant readings are missing
+    df = df.dropna(subset=POLLUTANTS, how="all")
+
+    # Derived features
+    df["AQI"] = pd.cut(df["pm2_5"], bins=AQI_BINS, labels=AQI_LABELS)
+    # Severity score and risk class in one fused pass over the pollutant columns
+    severity, risk = severity_and_risk(df[SEVERITY_COLS].to_numpy(dtype=np.float64, copy=False))
+    df["severity"] = severity
+    df["risk"] = pd.Categorical.from_codes(risk, categories=RISK_LABELS)
+    df["hour"] = df["time"].dt.hour.astype("int8")
+
+    # city repeats per row; pollutants stay float64 in memory (downcast in save())
+    df["city"] = df["city"].astype("category")
+    return df
+
+
+def transform_file(json_file: Path) -> Optional[pd.DataFrame]:
+    """Flatten and add derived features for a single raw file."""
+    frame = process_file(Path(json_file))
+    return add_features(frame) if frame is not None else None
+
+
+def save(df: pd.DataFrame) -> None:
+    # Concentrations fit in float32; narrow them only for the staged artifact
+    staged = df.astype({c: "float32" for c in POLLUTANTS})
+    # Save transformed Parquet (typed + compressed, no re-parse downstream)
+    staged.to_parquet(OUTPUT_FILE, compression="zstd", index=False)
+    print(f"Transformed data saved to: {OUTPUT_FILE}")
+
+
+def run(files: Optional[Iterable[Path]] = None) -> Optional[pd.DataFrame]:
+    """Transform raw JSON files (default: every file in RAW_DIR) and stage the result.
+
+    Returns None, leaving the staged file untouched, if no file yields data.
+    """
+    if files is None:
+        files = RAW_DIR.glob("*_raw_*.json")
+
+    # Files are independent, so flatten them in parallel worker processes
+    with ProcessPoolExecutor(max_workers=TRANSFORM_WORKERS) as ex:
+        frames = [f for f in ex.map(process_file, map(Path, files)) if f is not None]
+
+    if not frames:
+        print("⚠️ No raw data to transform (no readable raw JSON files); nothing staged.")
+        return None
+
+    # Create DataFrame
+    df = add_features(pd.concat(frames, copy=False, ignore_index=True))
+    save(df)
+    return df
+
+
+if __name__ == "__main__":
+    run()